@@ -0,0 +1,484 @@
+"""
+HealthIQ v2 — LLM Gateway core
+
+Provider routing, rate limiting and caching shared by both entry points:
+  - backend/llm_service.py  — persistent FastAPI service (v2)
+  - llm_adapter.py          — child-process path used by PromptBuilders.ts (v1)
+
+Kept free of web-framework imports so the per-call v1 child process starts
+quickly.
+
+Behavior:
+- Key rotation on failure
+- Rate limiting (token bucket)
+- Disk cache (SQLite WAL, fronted by an in-memory LRU)
+- Strict JSON enforcement for registered tasks
+- Simulation mode for dev/testing
+"""
+
+import os
+import sys
+import time
+import json
+import queue
+import atexit
+import sqlite3
+import hashlib
+import functools
+import itertools
+import threading
+import logging
+import importlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Optional
+
+import orjson
+
+# --- Environment ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BASE_DIR)
+
+from dotenv import load_dotenv
+load_dotenv(os.path.join(BASE_DIR, ".env"))
+load_dotenv(os.path.join(PROJECT_ROOT, ".env"))
+
+# --- Logger ---
+logger = logging.getLogger("healthiq.llm_service")
+if not logger.handlers:
+    h = logging.StreamHandler()
+    h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(h)
+logger.setLevel(logging.INFO)
+
+# --- SDK import ---
+GENAI_MODULE = None
+
+for name in ["google.generativeai", "google.genai", "genai"]:
+    try:
+        spec = importlib.util.find_spec(name)
+        if spec:
+            GENAI_MODULE = importlib.import_module(name)
+            break
+    except Exception:
+        pass
+
+# --- Config ---
+GEMINI_API_KEYS = [
+    os.getenv("GEMINI_API_KEY", ""),
+    os.getenv("GEMINI_API_KEY_2", ""),
+    os.getenv("GEMINI_API_KEY_3", ""),
+]
+GEMINI_API_KEYS = [k for k in GEMINI_API_KEYS if k]
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+_CACHE_FILE_ENV = os.getenv("SENTIQ_CACHE_FILE", "sentiq_cache.sqlite3")
+CACHE_FILE = _CACHE_FILE_ENV if os.path.isabs(_CACHE_FILE_ENV) else os.path.join(PROJECT_ROOT, _CACHE_FILE_ENV)
+RPM = int(os.getenv("SENTIQ_RPM", "120"))
+MEM_CACHE_SIZE = int(os.getenv("SENTIQ_MEM_CACHE_SIZE", "10000"))
+
+# --- Task registry ---
+# Shared with PromptBuilders.ts (single source of truth), kept at the project root.
+_REGISTRY_PATH = os.path.join(PROJECT_ROOT, "task_registry.json")
+try:
+    with open(_REGISTRY_PATH, "r", encoding="utf-8") as _f:
+        _registry = json.load(_f)
+    STRICT_JSON_TASKS = frozenset(sys.intern(t) for t in _registry.get("strict_json_tasks", []))
+except Exception as _e:
+    logger.error("Failed to load task_registry.json: %s", _e)
+    STRICT_JSON_TASKS = frozenset()
+
+# Sent as the Gemini system instruction for STRICT_JSON_TASKS rather than
+# being prepended to every prompt.
+JSON_SYSTEM_INSTRUCTION = "Respond ONLY with valid JSON. No markdown. No explanations."
+
+# --- Rate limiter ---
+class TokenBucket:
+    # Tokens are held in fixed point (TOKEN_SCALE units per token) and time in
+    # monotonic nanoseconds, so refill is integer-only and immune to
+    # wall-clock jumps.
+    TOKEN_SCALE = 1_000_000
+
+    def __init__(self, rpm):
+        self.capacity = rpm * self.TOKEN_SCALE
+        self.tokens = self.capacity
+        self.rate_num = rpm * self.TOKEN_SCALE
+        self.rate_den = 60_000_000_000
+        self.last = time.monotonic_ns()
+        self.lock = threading.Lock()
+
+    def consume(self, n=1):
+        # Read the clock before taking the lock so the critical section is
+        # only the refill arithmetic. A thread that read an older timestamp
+        # than the last writer sees a negative delta, which is clamped.
+        now = time.monotonic_ns()
+        cost = n * self.TOKEN_SCALE
+        with self.lock:
+            delta = now - self.last
+            if delta > 0:
+                self.last = now
+                self.tokens = min(self.capacity, self.tokens + delta * self.rate_num // self.rate_den)
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return True
+            return False
+
+bucket = TokenBucket(RPM)
+
+# --- Cache ---
+# Cache keys are lookup keys, not a security boundary, so use the fastest
+# available hash: BLAKE3 when installed, stdlib BLAKE2b otherwise.
+try:
+    from blake3 import blake3 as _new_hasher
+except ImportError:
+    def _new_hasher():
+        return hashlib.blake2b(digest_size=32)
+
+CACHE_KEY_MEMO_SIZE = 2048
+
+# The SQLite DB (WAL mode, so several processes can read while one writes)
+# is opened once per process; an LRU dict in front of it serves hot keys
+# without touching disk. _CACHE_LOCK guards only the dict, so memory hits
+# never wait on SQLite. Disk reads use their own connection and lock; disk
+# writes are queued and committed in batches by a background flusher thread
+# that owns the write connection.
+_CACHE_LOCK = threading.RLock()
+_MEM_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_WRITE_QUEUE: "queue.Queue" = queue.Queue()
+_DB_READ_LOCK = threading.Lock()
+
+# A batch that hits a locked database (another worker or v1 process writing)
+# is kept and retried rather than dropped. At shutdown it gets a bounded
+# number of attempts so exit is not held up indefinitely.
+CACHE_BUSY_TIMEOUT_S = 1.0
+CACHE_FLUSH_RETRY_DELAY_S = 0.5
+CACHE_FLUSH_EXIT_ATTEMPTS = 3
+
+def _connect_cache() -> sqlite3.Connection:
+    return sqlite3.connect(
+        CACHE_FILE, timeout=CACHE_BUSY_TIMEOUT_S, check_same_thread=False, isolation_level=None
+    )
+
+def _open_cache_db() -> sqlite3.Connection:
+    conn = _connect_cache()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, v BLOB)")
+    return conn
+
+try:
+    _CACHE_DB = _open_cache_db()
+    _CACHE_READER = _connect_cache()
+except Exception as _e:
+    logger.warning("Disk cache unavailable at %s: %s", CACHE_FILE, _e)
+    _CACHE_DB = None
+    _CACHE_READER = None
+
+# Hasher already fed the task|model|user_id| header. Chat-style traffic
+# repeats the same header with different prompts, so callers copy() this
+# state and only hash the prompt.
+@functools.lru_cache(maxsize=CACHE_KEY_MEMO_SIZE)
+def _header_hasher(task: str, model: str, user_id: str):
+    h = _new_hasher()
+    h.update(str(task).encode())
+    h.update(b"|")
+    h.update(model.encode())
+    h.update(b"|")
+    h.update(user_id.encode())
+    h.update(b"|")
+    return h
+
+# PRIVACY NOTE: Cache key includes the full prompt content, which contains
+# user-specific timeline events. Since different users have different events
+# in their prompts, cache entries are naturally user-isolated.
+# The cache key is: hash(task|model|user_id|prompt), so two users with
+# different timeline data will NEVER share a cache entry.
+# If user_id is provided, it is also included in the key for extra safety.
+@functools.lru_cache(maxsize=CACHE_KEY_MEMO_SIZE)
+def _cache_key(prompt: str, task: str, model: str, user_id: str = ""):
+    h = _header_hasher(task, model, user_id or "").copy()
+    # surrogatepass: prompts decoded from JSON may carry lone surrogates,
+    # which a strict encode would reject before the request is even made.
+    h.update(prompt if isinstance(prompt, bytes) else prompt.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+def _mem_cache_put(key: str, value: str) -> None:
+    _MEM_CACHE[key] = value
+    _MEM_CACHE.move_to_end(key)
+    if len(_MEM_CACHE) > MEM_CACHE_SIZE:
+        _MEM_CACHE.popitem(last=False)
+
+def _cache_get(key: str) -> Optional[str]:
+    with _CACHE_LOCK:
+        value = _MEM_CACHE.get(key)
+        if value is not None:
+            _MEM_CACHE.move_to_end(key)
+            return value
+    if _CACHE_READER is None:
+        return None
+    try:
+        with _DB_READ_LOCK:
+            row = _CACHE_READER.execute("SELECT v FROM cache WHERE k = ?", (key,)).fetchone()
+    except Exception:
+        return None
+    if row is None:
+        return None
+    with _CACHE_LOCK:
+        _mem_cache_put(key, row[0])
+    return row[0]
+
+def _cache_put(key: str, value: str) -> None:
+    with _CACHE_LOCK:
+        _mem_cache_put(key, value)
+    if _CACHE_DB is not None:
+        _WRITE_QUEUE.put((key, value))
+
+def _is_db_busy(e: Exception) -> bool:
+    msg = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in msg or "busy" in msg)
+
+def _write_batch(batch: list) -> bool:
+    """Commit a batch; return False if the DB was busy and it should be retried."""
+    try:
+        _CACHE_DB.execute("BEGIN IMMEDIATE")
+        _CACHE_DB.executemany("INSERT OR REPLACE INTO cache(k, v) VALUES (?, ?)", batch)
+        _CACHE_DB.execute("COMMIT")
+        return True
+    except Exception as e:
+        if _CACHE_DB.in_transaction:
+            _CACHE_DB.execute("ROLLBACK")
+        if _is_db_busy(e):
+            return False
+        logger.warning("Disk cache write failed, dropping %d entries: %s", len(batch), e)
+        return True
+
+def _cache_flusher() -> None:
+    pending: list = []
+    stop = False
+    busy_attempts = 0
+    while True:
+        if not pending and not stop:
+            pending.append(_WRITE_QUEUE.get())
+        while True:
+            try:
+                pending.append(_WRITE_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        if None in pending:
+            stop = True
+            pending = [item for item in pending if item is not None]
+        if pending:
+            if _write_batch(pending):
+                pending = []
+                busy_attempts = 0
+            else:
+                busy_attempts += 1
+                if stop and busy_attempts >= CACHE_FLUSH_EXIT_ATTEMPTS:
+                    logger.warning("Disk cache still locked at exit, dropping %d entries", len(pending))
+                    pending = []
+                else:
+                    time.sleep(CACHE_FLUSH_RETRY_DELAY_S)
+        if stop and not pending:
+            return
+
+def _close_cache() -> None:
+    # Drain pending writes before closing; daemon threads do not get to
+    # finish on their own at interpreter exit.
+    _WRITE_QUEUE.put(None)
+    _CACHE_FLUSHER.join(timeout=5)
+    with _DB_READ_LOCK:
+        _CACHE_READER.close()
+    if not _CACHE_FLUSHER.is_alive():
+        _CACHE_DB.close()
+
+if _CACHE_DB is not None:
+    _CACHE_FLUSHER = threading.Thread(target=_cache_flusher, name="llm-cache-flusher", daemon=True)
+    _CACHE_FLUSHER.start()
+    atexit.register(_close_cache)
+
+# --- Simulation ---
+# Responses for every strict-JSON task are built once at import.
+_SIM_CACHE = {t: '{"status":"simulated","task":"' + t + '"}' for t in STRICT_JSON_TASKS}
+
+def simulated_response(prompt: str, task: str) -> str:
+    return _SIM_CACHE.get(task, "SIMULATED RESPONSE")
+
+# --- Gemini invocation ---
+# One SDK client per API key and one GenerativeModel per (api_key, model,
+# system_instruction), built on first use. configure() installs global SDK
+# state and GenerativeModel resolves its client lazily from it, so each model
+# is pinned to its key's client at build time. Sharing the client keeps one
+# long-lived transport channel per key instead of one per model.
+_KEY_CLIENTS: dict = {}
+_MODEL_CACHE: dict = {}
+_MODEL_LOCK = threading.Lock()
+
+def _client_for_key(api_key: str):
+    client = _KEY_CLIENTS.get(api_key)
+    if client is None:
+        if hasattr(GENAI_MODULE, "configure"):
+            GENAI_MODULE.configure(api_key=api_key)
+        client_mod = getattr(GENAI_MODULE, "client", None)
+        client_factory = getattr(client_mod, "get_default_generative_client", None)
+        if client_factory is not None:
+            client = _KEY_CLIENTS[api_key] = client_factory()
+    return client
+
+def _get_model(api_key: str, model_name: str, system_instruction: Optional[str] = None):
+    cache_key = (api_key, model_name, system_instruction)
+    model_obj = _MODEL_CACHE.get(cache_key)
+    if model_obj is not None:
+        return model_obj
+    with _MODEL_LOCK:
+        model_obj = _MODEL_CACHE.get(cache_key)
+        if model_obj is None:
+            client = _client_for_key(api_key)
+            if system_instruction:
+                model_obj = GENAI_MODULE.GenerativeModel(model_name, system_instruction=system_instruction)
+            else:
+                model_obj = GENAI_MODULE.GenerativeModel(model_name)
+            if client is not None and getattr(model_obj, "_client", False) is None:
+                model_obj._client = client
+            _MODEL_CACHE[cache_key] = model_obj
+    return model_obj
+
+def _call_gemini(
+    prompt: str,
+    api_key: str,
+    model: Optional[str] = None,
+    system_instruction: Optional[str] = None,
+) -> str:
+    if not GENAI_MODULE:
+        raise RuntimeError("Gemini SDK not installed")
+    if not api_key:
+        raise RuntimeError("Gemini API key is empty")
+    if not bucket.consume():
+        raise RuntimeError("Rate limit exceeded")
+
+    model_obj = _get_model(api_key, model or GEMINI_MODEL, system_instruction)
+    resp = model_obj.generate_content(prompt)
+    return getattr(resp, "text", str(resp))
+
+# Keys are tried round-robin so load spreads evenly, and a key that Gemini
+# rate-limits is skipped for KEY_COOLDOWN_S seconds instead of costing every
+# request a failed round-trip.
+KEY_COOLDOWN_S = 30.0
+_KEY_COOLDOWN_UNTIL = [0.0] * len(GEMINI_API_KEYS)
+_KEY_CURSOR = itertools.count()
+
+def _is_quota_error(e: Exception) -> bool:
+    if getattr(e, "code", None) == 429 or type(e).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return True
+    msg = str(e).lower()
+    return "429" in msg or "quota" in msg or "resource_exhausted" in msg
+
+def _key_order() -> list:
+    n = len(GEMINI_API_KEYS)
+    start = next(_KEY_CURSOR) % n
+    order = [(start + i) % n for i in range(n)]
+    now = time.monotonic()
+    ready = [i for i in order if _KEY_COOLDOWN_UNTIL[i] <= now]
+    # If every key is cooling down, still try them all rather than fail outright.
+    return ready or order
+
+# --- Router ---
+# Cache keys with a Gemini call in progress, mapped to the future that
+# followers of the same key wait on.
+_INFLIGHT: "dict[str, Future]" = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+def _call_with_rotation(
+    prompt: str,
+    task: str,
+    key: str,
+    model_override: Optional[str],
+    system_instruction: Optional[str],
+) -> str:
+    # Key rotation
+    last_error = None
+    for i in _key_order():
+        try:
+            result = _call_gemini(prompt, GEMINI_API_KEYS[i], model_override, system_instruction)
+            # Cache result
+            _cache_put(key, result)
+            # Only a fallback to another key is worth an INFO line.
+            if last_error is not None:
+                logger.info("Gemini key #%d succeeded for task=%s after rotation", i + 1, task)
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Gemini key #%d succeeded for task=%s", i + 1, task)
+            return result
+        except Exception as e:
+            last_error = e
+            if _is_quota_error(e):
+                _KEY_COOLDOWN_UNTIL[i] = time.monotonic() + KEY_COOLDOWN_S
+            logger.warning("Gemini key #%d failed: %s", i + 1, e)
+
+    logger.error("All %d Gemini keys failed: %s", len(GEMINI_API_KEYS), last_error)
+    return orjson.dumps({"error": "all_providers_failed", "detail": str(last_error)}).decode()
+
+def call_llm_router(
+    prompt: str,
+    task: str = "general",
+    use_simulation: bool = False,
+    model_override: Optional[str] = None,
+    user_id: Optional[str] = None,
+    prefer: Optional[str] = None,
+) -> str:
+    # `prefer` is accepted for v1 callers and ignored: Gemini is the only provider.
+    if use_simulation:
+        return simulated_response(prompt, task)
+
+    if not GEMINI_API_KEYS:
+        logger.error("No Gemini API keys configured")
+        return orjson.dumps({"error": "no_api_keys", "detail": "No GEMINI_API_KEY values found"}).decode()
+
+    model = model_override or GEMINI_MODEL
+    key = _cache_key(prompt, task, model, user_id or "")
+
+    # Cache check
+    cached = _cache_get(key)
+    if cached is not None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Cache hit for task=%s", task)
+        return cached
+
+    # Enforce JSON if needed
+    system_instruction = JSON_SYSTEM_INSTRUCTION if task in STRICT_JSON_TASKS else None
+
+    # Single-flight: concurrent identical requests share one Gemini call
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _INFLIGHT[key] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        # A previous leader may have cached the result and left _INFLIGHT
+        # between our cache miss above and taking the lock.
+        result = _cache_get(key)
+        if result is None:
+            result = _call_with_rotation(prompt, task, key, model_override, system_instruction)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+# --- Backward-compatible API ---
+def call_llm(
+    prompt: str,
+    category: str = "general",
+    use_simulation: bool = False,
+    model_override: Optional[str] = None,
+) -> str:
+    return call_llm_router(
+        prompt=prompt,
+        task=category,
+        use_simulation=use_simulation,
+        model_override=model_override,
+    )